@@ -5,6 +5,7 @@ import logging
 import os
 import time
 import uuid
+from contextlib import asynccontextmanager
 from io import StringIO
 from typing import List, Optional
 import ast
@@ -34,6 +35,8 @@ from pydantic import BaseModel
 from scripts.format_response import format_response_to_markdown
 from src.agents.agents import *
 from src.agents.retrievers.retrievers import *
+from src.db.init_db import session_factory
+from src.db.schemas.models import AgentTemplate, DeepAnalysisReport
 from src.managers.ai_manager import AI_Manager
 from src.managers.session_manager import SessionManager
 from src.routes.analytics_routes import router as analytics_router
@@ -199,6 +202,9 @@ else:
 # lm = dspy.LM('openai/gpt-4o-mini', api_key=os.getenv("OPENAI_API_KEY"))
 # dspy.configure(lm=lm)
 
+# Size of the worker pool dspy.asyncify runs planner/agent calls on
+dspy.settings.configure(async_max_workers=int(os.getenv("DSPY_ASYNC_MAX_WORKERS", 8)))
+
 # Function to get model config from session or use default
 def get_session_lm(session_state):
     """Get the appropriate LM instance for a session, or default if not configured"""
@@ -357,7 +363,6 @@ class AppState:
             logger.log_message(f"Creating/recreating deep analyzer for session {session_id}, user_id: {user_id} (reason: analyzer_exists={current_analyzer is not None}, user_match={analyzer_user_id == user_id})", level=logging.INFO)
             
             # Load user-enabled agents from database using preference system
-            from src.db.init_db import session_factory
             from src.agents.agents import load_user_enabled_templates_for_planner_from_db
             
             db_session = session_factory()
@@ -421,8 +426,18 @@ class AppState:
         
         return session_state['deep_analyzer']
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Warm in-memory caches before serving requests and flush pending writes on shutdown"""
+    # Index agent descriptions once so planner prompts don't query the DB per agent
+    with session_factory() as db_session:
+        refresh_description_index(db_session)
+    yield
+    # Write template usage still waiting for the next background flush
+    await stop_template_usage_flusher()
+
 # Initialize FastAPI app with state
-app = FastAPI(title="AI Analytics API", version="1.0")
+app = FastAPI(title="AI Analytics API", version="1.0", lifespan=lifespan)
 app.state = AppState()
 
 
@@ -486,6 +501,25 @@ REQUEST_TIMEOUT_SECONDS = 30  # Timeout for LLM requests
 MAX_RECENT_MESSAGES = 3
 DB_BATCH_SIZE = 10  # For future batch DB operations
 
+# Constant lines of the chat_with_all NDJSON stream, encoded once instead of per request
+STREAM_LINE_INVALID_PLAN = json.dumps({"agent": "Analytical Planner", "content": RESPONSE_ERROR_INVALID_QUERY, "status": "error"}) + "\n"
+STREAM_LINE_PLAN_NOT_FOUND = json.dumps({
+    "agent": "Analytical Planner",
+    "content": "**No plan found**\n\nPlease try again with a different query or try using a different model.",
+    "status": "error"
+}) + "\n"
+STREAM_LINE_PLAN_NOT_FORMATTED = json.dumps({
+    "agent": "Analytical Planner",
+    "content": "**Something went wrong with formatting, retry the query!**",
+    "status": "error"
+}) + "\n"
+STREAM_LINE_TIMEOUT = json.dumps({"agent": "planner", "content": "The request timed out. Please try a simpler query.", "status": "error"}) + "\n"
+STREAM_LINE_GENERATION_ERROR = json.dumps({
+    "agent": "planner",
+    "content": "An error occurred while generating responses. Please try again!",
+    "status": "error"
+}) + "\n"
+
 @app.post("/chat/{agent_name}", response_model=dict)
 async def chat_with_agent(
     agent_name: str, 
@@ -526,9 +560,10 @@ async def chat_with_agent(
             agent_list = [agent.strip() for agent in agent_name.split(",")]
             
             # Categorize agents
+            template_names = _template_agent_names(agent_list)
             standard_agents = [agent for agent in agent_list if _is_standard_agent(agent)]
-            template_agents = [agent for agent in agent_list if _is_template_agent(agent)]
-            custom_agents = [agent for agent in agent_list if not _is_standard_agent(agent) and not _is_template_agent(agent)]
+            template_agents = [agent for agent in agent_list if agent in template_names]
+            custom_agents = [agent for agent in agent_list if not _is_standard_agent(agent) and agent not in template_names]
             
             logger.log_message(f"[DEBUG] Agent categorization - standard: {standard_agents}, template: {template_agents}, custom: {custom_agents}", level=logging.DEBUG)
             
@@ -542,14 +577,14 @@ async def chat_with_agent(
                         _execute_custom_agents(ai_system, agent_list, enhanced_query),
                         timeout=REQUEST_TIMEOUT_SECONDS
                     )
-                    logger.log_message(f"[DEBUG] Custom agents response type: {type(response)}, keys: {list(response.keys()) if isinstance(response, dict) else 'not a dict'}", level=logging.DEBUG)
+                    if logger.is_enabled_for(logging.DEBUG):
+                        logger.log_message(f"[DEBUG] Custom agents response type: {type(response)}, keys: {list(response.keys()) if isinstance(response, dict) else 'not a dict'}", level=logging.DEBUG)
             else:
                 # All standard/template agents - use auto_analyst_ind which loads from DB
                 user_id = session_state.get("user_id")
                 logger.log_message(f"[DEBUG] Using auto_analyst_ind for multiple standard/template agents with user_id: {user_id}", level=logging.DEBUG)
         
                 # Create database session for agent loading
-                from src.db.init_db import session_factory
                 db_session = session_factory()
                 try:
                     # auto_analyst_ind will load all agents from database
@@ -562,7 +597,8 @@ async def chat_with_agent(
                             agent.forward(enhanced_query, ",".join(agent_list)),
                             timeout=REQUEST_TIMEOUT_SECONDS
                         )
-                        logger.log_message(f"[DEBUG] auto_analyst_ind response type: {type(response)}, content: {str(response)[:200]}...", level=logging.DEBUG)
+                        if logger.is_enabled_for(logging.DEBUG):
+                            logger.log_message(f"[DEBUG] auto_analyst_ind response type: {type(response)}, content: {str(response)[:200]}...", level=logging.DEBUG)
                 finally:
                     db_session.close()
         else:
@@ -574,7 +610,6 @@ async def chat_with_agent(
                 logger.log_message(f"[DEBUG] Using auto_analyst_ind for single standard/template agent '{agent_name}' with user_id: {user_id}", level=logging.DEBUG)
                 
                 # Create database session for agent loading
-                from src.db.init_db import session_factory
                 db_session = session_factory()
                 try:
                     # auto_analyst_ind will load all agents from database
@@ -587,7 +622,8 @@ async def chat_with_agent(
                             agent.forward(enhanced_query, agent_name),
                             timeout=REQUEST_TIMEOUT_SECONDS
                         )
-                        logger.log_message(f"[DEBUG] Single agent response type: {type(response)}, content: {str(response)[:200]}...", level=logging.DEBUG)
+                        if logger.is_enabled_for(logging.DEBUG):
+                            logger.log_message(f"[DEBUG] Single agent response type: {type(response)}, content: {str(response)[:200]}...", level=logging.DEBUG)
                 finally:
                     db_session.close()
             else:
@@ -600,11 +636,13 @@ async def chat_with_agent(
                         _execute_custom_agents(ai_system, [agent_name], enhanced_query),
                         timeout=REQUEST_TIMEOUT_SECONDS
                     )
-                    logger.log_message(f"[DEBUG] Custom single agent response type: {type(response)}, content: {str(response)[:200]}...", level=logging.DEBUG)
+                    if logger.is_enabled_for(logging.DEBUG):
+                        logger.log_message(f"[DEBUG] Custom single agent response type: {type(response)}, content: {str(response)[:200]}...", level=logging.DEBUG)
         
         logger.log_message(f"[DEBUG] About to format response to markdown. Response type: {type(response)}", level=logging.DEBUG)
         formatted_response = format_response_to_markdown(response, agent_name, session_state["current_df"])
-        logger.log_message(f"[DEBUG] Formatted response type: {type(formatted_response)}, length: {len(str(formatted_response))}", level=logging.DEBUG)
+        if logger.is_enabled_for(logging.DEBUG):
+            logger.log_message(f"[DEBUG] Formatted response type: {type(formatted_response)}, length: {len(str(formatted_response))}", level=logging.DEBUG)
         
         if formatted_response == RESPONSE_ERROR_INVALID_QUERY:
             logger.log_message(f"[DEBUG] Response was invalid query error", level=logging.DEBUG)
@@ -765,7 +803,6 @@ def _is_agent_available(agent_name: str, session_state: dict = None) -> bool:
 
 def _get_available_agents_list(session_state: dict = None) -> list:
     """Get list of all available agents from database"""
-    from src.db.init_db import session_factory
     from src.agents.agents import load_all_available_templates_from_db
     
     # Core agents (always available)
@@ -793,22 +830,24 @@ def _is_standard_agent(agent_name: str) -> bool:
 
 def _is_template_agent(agent_name: str) -> bool:
     """Check if agent is a template agent"""
+    return agent_name in _template_agent_names([agent_name])
+
+def _template_agent_names(agent_names: list) -> set:
+    """Names among agent_names that are active template agents, checked with one session and query"""
+    # Answered from the template index, which is rebuilt every DESCRIPTION_INDEX_TTL seconds
+    indexed_names = active_template_names()
+    if indexed_names is not None:
+        return indexed_names.intersection(agent_names)
     try:
-        from src.db.init_db import session_factory
-        from src.db.schemas.models import AgentTemplate
-        
-        db_session = session_factory()
-        try:
-            template = db_session.query(AgentTemplate).filter(
-                AgentTemplate.template_name == agent_name,
+        with session_factory() as db_session:
+            rows = db_session.query(AgentTemplate.template_name).filter(
+                AgentTemplate.template_name.in_(set(agent_names)),
                 AgentTemplate.is_active == True
-            ).first()
-            return template is not None
-        finally:
-            db_session.close()
+            ).all()
+            return {name for (name,) in rows}
     except Exception as e:
-        logger.log_message(f"Error checking if {agent_name} is template: {str(e)}", level=logging.ERROR)
-        return False
+        logger.log_message(f"Error checking if {agent_names} are templates: {str(e)}", level=logging.ERROR)
+        return set()
 
 async def _execute_custom_agents(ai_system, agent_names: list, query: str):
     """Execute custom agents using the session's AI system"""
@@ -819,14 +858,13 @@ async def _execute_custom_agents(ai_system, agent_names: list, query: str):
             agent_name = agent_names[0]
             # Prepare inputs for the custom agent (similar to standard agents like data_viz_agent)
             dict_ = {}
-            dict_['dataset'] = ai_system.dataset.retrieve(query)[0].text
-            dict_['styling_index'] = ai_system.styling_index.retrieve(query)[0].text
+            dict_['dataset'], dict_['styling_index'] = await retrieve_context(ai_system.dataset, ai_system.styling_index, query, getattr(ai_system, 'retrieval_cache', None))
             dict_['goal'] = query
-            dict_['Agent_desc'] = str(ai_system.agent_desc)
+            dict_['Agent_desc'] = ai_system.agent_desc_str
 
             # Get input fields for this agent
             if agent_name in ai_system.agent_inputs:
-                inputs = {x: dict_[x] for x in ai_system.agent_inputs[agent_name] if x in dict_}
+                inputs = ai_system.build_inputs(agent_name, dict_, query)
                 
                 # Execute the custom agent
                 agent_name_result, result_dict = await ai_system.execute_agent(agent_name, inputs)
@@ -922,11 +960,16 @@ async def _generate_streaming_responses(session_state: dict, query: str, session
 
     # Add chat context from previous messages
     enhanced_query = _prepare_query_with_context(query, session_state)
+    plan_events = []
     
     try:
         # Get the plan - planner is now async, so we need to await it
         plan_response = await session_state["ai_system"].get_plan(enhanced_query)
         
+        # Start the plan's agents right away so they run while the plan itself is formatted and streamed
+        with dspy.context(lm = session_lm):
+            plan_events = await session_state["ai_system"].start_plan(enhanced_query, plan_response)
+        
         plan_description = format_response_to_markdown(
             {"analytical_planner": plan_response}, 
             dataframe=session_state["current_df"]
@@ -934,11 +977,7 @@ async def _generate_streaming_responses(session_state: dict, query: str, session
         
         # Check if plan is valid
         if plan_description == RESPONSE_ERROR_INVALID_QUERY:
-            yield json.dumps({
-                "agent": "Analytical Planner",
-                "content": plan_description,
-                "status": "error"
-            }) + "\n"
+            yield STREAM_LINE_INVALID_PLAN
             return
         
         yield json.dumps({
@@ -964,8 +1003,9 @@ async def _generate_streaming_responses(session_state: dict, query: str, session
                 is_streaming=False
             ))
         
-        logger.log_message(f"Plan response: {plan_response}", level=logging.INFO)
-        logger.log_message(f"Plan response type: {type(plan_response)}", level=logging.INFO)
+        if logger.is_enabled_for(logging.INFO):
+            logger.log_message(f"Plan response: {plan_response}", level=logging.INFO)
+            logger.log_message(f"Plan response type: {type(plan_response)}", level=logging.INFO)
 
         # Check if plan_response is valid
         # if not plan_response or not isinstance(plan_response, dict):
@@ -980,22 +1020,14 @@ async def _generate_streaming_responses(session_state: dict, query: str, session
         with dspy.context(lm = session_lm):
             try:
                 
-                async for agent_name, inputs, response in session_state["ai_system"].execute_plan(enhanced_query, plan_response):
+                async for agent_name, inputs, response in session_state["ai_system"].stream_plan(plan_events):
                     
                     if agent_name == "plan_not_found":
-                        yield json.dumps({
-                            "agent": "Analytical Planner",
-                            "content": "**No plan found**\n\nPlease try again with a different query or try using a different model.",
-                            "status": "error"
-                        }) + "\n"
+                        yield STREAM_LINE_PLAN_NOT_FOUND
                         return
                         
                     if agent_name == "plan_not_formated_correctly":
-                        yield json.dumps({
-                            "agent": "Analytical Planner",
-                            "content": "**Something went wrong with formatting, retry the query!**",
-                            "status": "error"
-                        }) + "\n"
+                        yield STREAM_LINE_PLAN_NOT_FORMATTED
                         return
                     
 
@@ -1059,11 +1091,7 @@ async def _generate_streaming_responses(session_state: dict, query: str, session
                         ))
                         
             except asyncio.TimeoutError:
-                yield json.dumps({
-                    "agent": "planner",
-                    "content": "The request timed out. Please try a simpler query.",
-                    "status": "error"
-                }) + "\n"
+                yield STREAM_LINE_TIMEOUT
                 return
                 
             except Exception as e:
@@ -1077,11 +1105,11 @@ async def _generate_streaming_responses(session_state: dict, query: str, session
                 
     except Exception as e:
             logger.log_message(f"Error in streaming response: {str(e)}", level=logging.ERROR)
-            yield json.dumps({
-                "agent": "planner",
-                "content": "An error occurred while generating responses. Please try again!",
-                "status": "error"
-            }) + "\n"
+            yield STREAM_LINE_GENERATION_ERROR
+    finally:
+        # Stop agents that were started for a plan that ended up not being streamed
+        for event in plan_events:
+            event.cancel()
 
 
 def _estimate_tokens(ai_manager, input_text: str, output_text: str) -> dict:
@@ -1146,27 +1174,16 @@ async def list_agents(request: Request, session_id: str = Depends(get_session_id
     session_state = app.state.get_session_state(session_id)
     
     try:
-        # Get all available agents from database and session
-        available_agents_list = _get_available_agents_list(session_state)
-        
         # Categorize agents
         standard_agents = ["preprocessing_agent", "statistical_analytics_agent", "sk_learn_agent", "data_viz_agent"]
         
-        # Get template agents from database
-        from src.db.init_db import session_factory
-        from src.agents.agents import load_all_available_templates_from_db
-        
-        db_session = session_factory()
-        try:
-            template_agents_dict = load_all_available_templates_from_db(db_session)
-            # template_agents_dict is a dict with template_name as keys
-            template_agents = [template_name for template_name in template_agents_dict.keys() 
-                             if template_name not in standard_agents and template_name != 'basic_qa_agent']
-        except Exception as e:
-            logger.log_message(f"Error loading template agents in /agents endpoint: {str(e)}", level=logging.ERROR)
-            template_agents = []
-        finally:
-            db_session.close()
+        # Load the templates once, in a worker thread so the event loop is not blocked;
+        # both the available list and the template list are built from the same rows
+        template_agents_dict = await load_all_available_templates_from_db_async()
+        # template_agents_dict is a dict with template_name as keys
+        template_agents = [template_name for template_name in template_agents_dict.keys() 
+                         if template_name not in standard_agents and template_name != 'basic_qa_agent']
+        available_agents_list = standard_agents + template_agents
         
         # Get custom agents from session
         custom_agents = []
@@ -1254,9 +1271,6 @@ async def deep_analysis_streaming(
         
         # Create initial pending report in the database
         try:
-            from src.db.init_db import session_factory
-            from src.db.schemas.models import DeepAnalysisReport
-            
             db_session = session_factory()
             
             try:
@@ -1335,9 +1349,6 @@ async def _generate_deep_analysis_stream(session_state: dict, goal: str, session
                 return
                 
             try:
-                from src.db.init_db import session_factory
-                from src.db.schemas.models import DeepAnalysisReport
-                
                 db_session = session_factory()
                 
                 try:
@@ -1603,9 +1614,6 @@ async def download_html_report(
         # Save report to database if we have a UUID
         if report_uuid:
             try:
-                from src.db.init_db import session_factory
-                from src.db.schemas.models import DeepAnalysisReport
-                
                 db_session = session_factory()
                 try:
                     # Try to find existing report by UUID
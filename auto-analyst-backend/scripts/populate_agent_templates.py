@@ -8,9 +8,11 @@ Reads agents from agents_config.json and manages SQLite database.
 import sys
 import os
 import json
+import hashlib
 import requests
 from datetime import datetime, UTC
 from pathlib import Path
+from types import MappingProxyType
 
 # Add the project root to the Python path
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -21,10 +23,22 @@ project_root = os.path.dirname(os.path.dirname(backend_dir))
 os.chdir(backend_dir)
 sys.path.append(backend_dir)
 
-from src.db.init_db import session_factory, DATABASE_URL
-from src.db.schemas.models import AgentTemplate
+from src.db.init_db import engine, session_factory, DATABASE_URL
+from src.db.schemas.models import AgentTemplate, AppMeta
+from sqlalchemy import bindparam, delete, event, func, insert, inspect, text, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.exc import IntegrityError
 
+# Columns refreshed from agents_config.json when a template already exists
+SYNCED_COLUMNS = (
+    'display_name', 'description', 'icon_url', 'prompt_template', 'category',
+    'is_premium_only', 'is_active', 'variant_type', 'base_agent', 'updated_at'
+)
+# Synced columns that carry template content; a template is rewritten only if one of these changed
+CONTENT_COLUMNS = tuple(column for column in SYNCED_COLUMNS if column != 'updated_at')
+# app_meta key holding the fingerprint of the last config that was fully synced
+CONFIG_FINGERPRINT_KEY = 'agents_config_fingerprint'
+
 def get_database_type():
     """Detect database type from DATABASE_URL"""
     if DATABASE_URL.startswith('postgresql'):
@@ -34,6 +48,37 @@ def get_database_type():
     else:
         return "unknown"
 
+def supports_upsert(session):
+    """Whether this SQLite database accepts INSERT ... ON CONFLICT DO UPDATE (3.24+)"""
+    return (session.get_bind().dialect.server_version_info or (0,)) >= (3, 24, 0)
+
+def relax_commit_durability(session):
+    """
+    Skip the fsync when this session commits. Only meant for template seeding: a seed lost to
+    a crash is simply redone on the next start.
+    """
+    db_type = get_database_type()
+    if db_type == "postgresql":
+        # Reached from create_minimal_templates, which has no SQLite-only guard.
+        # LOCAL reverts on its own when the transaction ends
+        session.execute(text("SET LOCAL synchronous_commit = off"))
+    elif db_type == "sqlite":
+        # Per connection: remember the current level so it is restored when the connection
+        # goes back to the pool (populate_templates also runs inside init_production_db)
+        connection_info = session.connection().connection.info
+        if "restore_synchronous" not in connection_info:
+            connection_info["restore_synchronous"] = session.execute(text("PRAGMA synchronous")).scalar()
+        session.execute(text("PRAGMA synchronous = OFF"))
+
+@event.listens_for(engine, "checkin")
+def restore_sqlite_synchronous(dbapi_connection, connection_record):
+    """Undo relax_commit_durability before a pooled SQLite connection is handed to anyone else"""
+    previous = connection_record.info.pop("restore_synchronous", None)
+    if previous is not None:
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA synchronous = {int(previous)}")
+        cursor.close()
+
 def load_agents_config():
     """Load agents configuration from agents_config.json"""
     # Try multiple possible locations for agents_config.json
@@ -60,6 +105,39 @@ def load_agents_config():
     
     return config.get('templates', [])
 
+def load_remove_list():
+    """Load the template names listed under 'remove' in agents_config.json"""
+    possible_paths = [
+        os.path.join(backend_dir, 'agents_config.json'),
+        os.path.join(project_root, 'agents_config.json'),
+        '/app/agents_config.json',
+        'agents_config.json'
+    ]
+    
+    try:
+        for path in possible_paths:
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    return json.load(f).get('remove', [])
+    except Exception as e:
+        print(f"⚠️ Could not load removal list: {e}")
+    return []
+
+def config_fingerprint(templates_config, remove_list):
+    """Stable hash of everything a sync writes, so an unchanged config can be skipped"""
+    payload = json.dumps([templates_config, remove_list], sort_keys=True, ensure_ascii=False)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+def template_table_state(session):
+    """
+    Row count and latest updated_at of agent_templates. Stored with the config fingerprint so
+    that writes from anywhere else (minimal templates, manual inserts or deletes) force a full sync.
+    """
+    count, last_updated = session.query(
+        func.count(AgentTemplate.template_id), func.max(AgentTemplate.updated_at)
+    ).one()
+    return f"{count}:{last_updated}"
+
 def download_icon(icon_url, template_name):
     """Download icon from URL and save to frontend directory"""
     if not icon_url or not icon_url.startswith('http'):
@@ -111,8 +189,13 @@ def download_icon(icon_url, template_name):
         print(f"❌ Failed to download icon for {template_name}: {str(e)}")
         return icon_url
 
-def sync_agents_from_config():
-    """Synchronize agents from agents_config.json to SQLite database"""
+def sync_agents_from_config(force=False):
+    """
+    Synchronize agents from agents_config.json to SQLite database
+
+    Args:
+        force: Run the full sync even if the config and template table look unchanged since the last one
+    """
     session = session_factory()
     db_type = get_database_type()
     
@@ -130,6 +213,18 @@ def sync_agents_from_config():
             print("❌ No templates found in agents_config.json")
             return
         
+        remove_list = load_remove_list()
+        
+        # Restarts normally find the config and the table unchanged since the last sync
+        AppMeta.__table__.create(bind=session.get_bind(), checkfirst=True)
+        fingerprint = config_fingerprint(templates_config, remove_list)
+        stored = session.get(AppMeta, CONFIG_FINGERPRINT_KEY)
+        if not force and stored is not None and stored.value == f"{fingerprint}:{template_table_state(session)}":
+            print("⏭️ agents_config.json and templates unchanged since the last sync, nothing to do (use --force to sync anyway)")
+            return
+        
+        relax_commit_durability(session)
+        
         # Track statistics
         created_count = 0
         updated_count = 0
@@ -146,6 +241,23 @@ def sync_agents_from_config():
                 categories[category] = []
             categories[category].append(template_data)
         
+        # Current content of the templates already in the database, to tell created, updated
+        # and unchanged apart
+        existing_content = {
+            name: tuple(content)
+            for name, *content in session.query(
+                AgentTemplate.template_name,
+                *(getattr(AgentTemplate, column) for column in CONTENT_COLUMNS)
+            ).filter(
+                AgentTemplate.template_name.in_([t["template_name"] for t in templates_config])
+            ).all()
+        }
+        
+        # One row per template name; written below in a single upsert
+        rows = {}
+        new_names = set()
+        now = datetime.now(UTC)
+        
         # Process templates by category
         for category, templates in categories.items():
             print(f"\n📁 {category}:")
@@ -153,96 +265,96 @@ def sync_agents_from_config():
             for template_data in templates:
                 template_name = template_data["template_name"]
                 
-                # Check if template already exists
-                existing = session.query(AgentTemplate).filter(
-                    AgentTemplate.template_name == template_name
-                ).first()
-                
                 # Download icon if it's a URL
                 icon_url = template_data.get("icon_url", "")
                 if icon_url.startswith('http'):
                     icon_url = download_icon(icon_url, template_name)
                 
-                if existing:
-                    # Update existing template
-                    existing.display_name = template_data["display_name"]
-                    existing.description = template_data["description"]
-                    existing.icon_url = icon_url
-                    existing.prompt_template = template_data["prompt_template"]
-                    existing.category = template_data.get("category", "Uncategorized")
-                    existing.is_premium_only = template_data.get("is_premium_only", False)
-                    existing.is_active = template_data.get("is_active", True)
-                    existing.variant_type = template_data.get("variant_type", "individual")
-                    existing.base_agent = template_data.get("base_agent", template_name)
-                    existing.updated_at = datetime.now(UTC)
-                    
-                    variant_icon = "🤖" if template_data.get("variant_type") == "planner" else "👤"
-                    premium_icon = "🔒" if template_data.get("is_premium_only") else "🆓"
-                    print(f"🔄 Updated: {template_name} {variant_icon} {premium_icon}")
-                    updated_count += 1
-                else:
-                    # Create new template
-                    template = AgentTemplate(
-                        template_name=template_name,
-                        display_name=template_data["display_name"],
-                        description=template_data["description"],
-                        icon_url=icon_url,
-                        prompt_template=template_data["prompt_template"],
-                        category=template_data.get("category", "Uncategorized"),
-                        is_premium_only=template_data.get("is_premium_only", False),
-                        is_active=template_data.get("is_active", True),
-                        variant_type=template_data.get("variant_type", "individual"),
-                        base_agent=template_data.get("base_agent", template_name),
-                        created_at=datetime.now(UTC),
-                        updated_at=datetime.now(UTC)
-                    )
-                    
-                    session.add(template)
-                    variant_icon = "🤖" if template_data.get("variant_type") == "planner" else "👤"
-                    premium_icon = "🔒" if template_data.get("is_premium_only") else "🆓"
+                row = {
+                    "template_name": template_name,
+                    "display_name": template_data["display_name"],
+                    "description": template_data["description"],
+                    "icon_url": icon_url,
+                    "prompt_template": template_data["prompt_template"],
+                    "category": template_data.get("category", "Uncategorized"),
+                    "is_premium_only": template_data.get("is_premium_only", False),
+                    "is_active": template_data.get("is_active", True),
+                    "variant_type": template_data.get("variant_type", "individual"),
+                    "base_agent": template_data.get("base_agent", template_name),
+                    "created_at": now,
+                    "updated_at": now
+                }
+                
+                variant_icon = "🤖" if template_data.get("variant_type") == "planner" else "👤"
+                premium_icon = "🔒" if template_data.get("is_premium_only") else "🆓"
+                content = tuple(row[column] for column in CONTENT_COLUMNS)
+                current = existing_content.get(template_name)
+                if current is None:
                     print(f"✅ Created: {template_name} {variant_icon} {premium_icon}")
                     created_count += 1
-        
-        # Handle removals if specified in config
-        remove_list = []
-        # Re-load the full config to check for removals
-        try:
-            full_config_path = None
-            possible_paths = [
-                os.path.join(backend_dir, 'agents_config.json'),
-                os.path.join(project_root, 'agents_config.json'),
-                '/app/agents_config.json',
-                'agents_config.json'
+                    new_names.add(template_name)
+                elif current == content:
+                    # Already in sync, leave the row (and its updated_at) alone
+                    print(f"⏭️ Unchanged: {template_name} {variant_icon} {premium_icon}")
+                    skipped_count += 1
+                    continue
+                else:
+                    print(f"🔄 Updated: {template_name} {variant_icon} {premium_icon}")
+                    updated_count += 1
+                existing_content[template_name] = content
+                rows[template_name] = row
+        
+        # Insert new templates and refresh changed ones in one statement
+        if rows and supports_upsert(session):
+            stmt = sqlite_insert(AgentTemplate.__table__).values(list(rows.values()))
+            session.execute(stmt.on_conflict_do_update(
+                index_elements=['template_name'],
+                set_={column: stmt.excluded[column] for column in SYNCED_COLUMNS}
+            ))
+        elif rows:
+            # No ON CONFLICT support: one executemany INSERT for new templates and one
+            # executemany UPDATE keyed on template_name for changed ones
+            new_rows = [row for name, row in rows.items() if name in new_names]
+            changed_rows = [
+                {"_template_name": name, **{column: row[column] for column in SYNCED_COLUMNS}}
+                for name, row in rows.items() if name not in new_names
             ]
-            
-            for path in possible_paths:
-                if os.path.exists(path):
-                    full_config_path = path
-                    break
-            
-            if full_config_path:
-                with open(full_config_path, 'r', encoding='utf-8') as f:
-                    full_config = json.load(f)
-                    if 'remove' in full_config:
-                        remove_list = full_config['remove']
-        except Exception as e:
-            print(f"⚠️ Could not load removal list: {e}")
+            if new_rows:
+                session.execute(insert(AgentTemplate), new_rows)
+            if changed_rows:
+                table = AgentTemplate.__table__
+                session.execute(
+                    update(table).where(table.c.template_name == bindparam("_template_name")),
+                    changed_rows
+                )
         
         # Remove templates marked for removal
         if remove_list:
             print(f"\n🗑️ --- Processing Removals ---")
+            removable_names = {
+                name for (name,) in session.query(AgentTemplate.template_name).filter(
+                    AgentTemplate.template_name.in_(remove_list)
+                ).all()
+            }
             for template_name in remove_list:
-                existing = session.query(AgentTemplate).filter(
-                    AgentTemplate.template_name == template_name
-                ).first()
-                
-                if existing:
-                    session.delete(existing)
+                if template_name in removable_names:
                     print(f"🗑️ Removed: {template_name}")
                 else:
                     print(f"⏭️ Skipping removal: {template_name} (not found)")
-        
-        # Commit all changes
+            
+            # One DELETE in the same transaction as the upsert, instead of loading each template
+            # (and its preferences) for the ORM to delete at flush. Preferences are removed by the
+            # foreign key's ON DELETE CASCADE.
+            if removable_names:
+                session.execute(delete(AgentTemplate).where(AgentTemplate.template_name.in_(removable_names)))
+        
+        # Record the synced config and the resulting table state with the upsert and removals,
+        # so all of them commit together
+        synced_state = f"{fingerprint}:{template_table_state(session)}"
+        if stored is None:
+            session.add(AppMeta(key=CONFIG_FINGERPRINT_KEY, value=synced_state))
+        else:
+            stored.value = synced_state
         session.commit()
         
         print(f"\n📊 --- Summary ---")
@@ -313,6 +425,9 @@ def remove_all_templates():
     
     try:
         deleted_count = session.query(AgentTemplate).delete()
+        # Forget the last synced config so the next sync repopulates
+        if inspect(session.get_bind()).has_table(AppMeta.__tablename__):
+            session.query(AppMeta).filter(AppMeta.key == CONFIG_FINGERPRINT_KEY).delete()
         session.commit()
         print(f"🗑️ Removed {deleted_count} templates from database")
     
@@ -373,87 +488,84 @@ def validate_config():
     except Exception as e:
         print(f"❌ Error validating config: {str(e)}")
 
+# Essential templates for container environments without agents_config.json. Built once at
+# import and read-only, since create_minimal_templates only reads them.
+MINIMAL_TEMPLATES = (
+    MappingProxyType({
+        "template_name": "preprocessing_agent",
+        "display_name": "Data Preprocessing Agent",
+        "description": "Cleans and prepares DataFrame using Pandas and NumPy",
+        "icon_url": "/icons/templates/preprocessing_agent.svg",
+        "category": "Data Manipulation",
+        "is_premium_only": False,
+        "variant_type": "individual",
+        "base_agent": "preprocessing_agent",
+        "is_active": True,
+        "prompt_template": "You are a preprocessing agent that cleans and prepares data using Pandas and NumPy. Handle missing values, detect column types, and convert date strings to datetime. Generate clean Python code for data preprocessing based on the user's analysis goals."
+    }),
+    MappingProxyType({
+        "template_name": "data_viz_agent",
+        "display_name": "Data Visualization Agent",
+        "description": "Creates interactive visualizations using Plotly",
+        "icon_url": "/icons/templates/data_viz_agent.svg",
+        "category": "Data Visualization",
+        "is_premium_only": False,
+        "variant_type": "individual",
+        "base_agent": "data_viz_agent",
+        "is_active": True,
+        "prompt_template": "You are a data visualization agent. Create interactive visualizations using Plotly based on user requirements. Generate appropriate chart types, apply styling, and ensure visualizations effectively communicate insights."
+    }),
+    MappingProxyType({
+        "template_name": "sk_learn_agent",
+        "display_name": "Machine Learning Agent",
+        "description": "Trains ML models using scikit-learn",
+        "icon_url": "/icons/templates/sk_learn_agent.svg",
+        "category": "Data Modelling",
+        "is_premium_only": False,
+        "variant_type": "individual",
+        "base_agent": "sk_learn_agent",
+        "is_active": True,
+        "prompt_template": "You are a machine learning agent. Use scikit-learn to train and evaluate ML models including classification, regression, and clustering. Provide feature importance insights and model performance metrics."
+    })
+)
+MINIMAL_TEMPLATE_NAMES = tuple(template["template_name"] for template in MINIMAL_TEMPLATES)
+
 def create_minimal_templates():
     """Create a minimal set of essential templates for container environments"""
     session = session_factory()
     
     try:
         print("🔧 Creating minimal template set...")
+        relax_commit_durability(session)
         
-        # Define minimal essential templates
-        minimal_templates = [
-            {
-                "template_name": "preprocessing_agent",
-                "display_name": "Data Preprocessing Agent",
-                "description": "Cleans and prepares DataFrame using Pandas and NumPy",
-                "icon_url": "/icons/templates/preprocessing_agent.svg",
-                "category": "Data Manipulation",
-                "is_premium_only": False,
-                "variant_type": "individual",
-                "base_agent": "preprocessing_agent",
-                "is_active": True,
-                "prompt_template": "You are a preprocessing agent that cleans and prepares data using Pandas and NumPy. Handle missing values, detect column types, and convert date strings to datetime. Generate clean Python code for data preprocessing based on the user's analysis goals."
-            },
-            {
-                "template_name": "data_viz_agent",
-                "display_name": "Data Visualization Agent",
-                "description": "Creates interactive visualizations using Plotly",
-                "icon_url": "/icons/templates/data_viz_agent.svg",
-                "category": "Data Visualization",
-                "is_premium_only": False,
-                "variant_type": "individual",
-                "base_agent": "data_viz_agent",
-                "is_active": True,
-                "prompt_template": "You are a data visualization agent. Create interactive visualizations using Plotly based on user requirements. Generate appropriate chart types, apply styling, and ensure visualizations effectively communicate insights."
-            },
-            {
-                "template_name": "sk_learn_agent",
-                "display_name": "Machine Learning Agent",
-                "description": "Trains ML models using scikit-learn",
-                "icon_url": "/icons/templates/sk_learn_agent.svg",
-                "category": "Data Modelling",
-                "is_premium_only": False,
-                "variant_type": "individual",
-                "base_agent": "sk_learn_agent",
-                "is_active": True,
-                "prompt_template": "You are a machine learning agent. Use scikit-learn to train and evaluate ML models including classification, regression, and clustering. Provide feature importance insights and model performance metrics."
-            }
-        ]
+        # Check which templates already exist with one query
+        existing_names = {
+            name for (name,) in session.query(AgentTemplate.template_name).filter(
+                AgentTemplate.template_name.in_(MINIMAL_TEMPLATE_NAMES)
+            ).all()
+        }
         
-        created_count = 0
+        # New templates as plain rows, inserted together below instead of one ORM object each
+        to_insert = []
+        now = datetime.now(UTC)
         
-        for template_data in minimal_templates:
+        for template_data in MINIMAL_TEMPLATES:
             template_name = template_data["template_name"]
             
-            # Check if template already exists
-            existing = session.query(AgentTemplate).filter(
-                AgentTemplate.template_name == template_name
-            ).first()
-            
-            if not existing:
-                template = AgentTemplate(
-                    template_name=template_name,
-                    display_name=template_data["display_name"],
-                    description=template_data["description"],
-                    icon_url=template_data["icon_url"],
-                    prompt_template=template_data["prompt_template"],
-                    category=template_data["category"],
-                    is_premium_only=template_data["is_premium_only"],
-                    is_active=template_data["is_active"],
-                    variant_type=template_data["variant_type"],
-                    base_agent=template_data["base_agent"],
-                    created_at=datetime.now(UTC),
-                    updated_at=datetime.now(UTC)
-                )
-                
-                session.add(template)
+            if template_name not in existing_names:
+                to_insert.append({
+                    **template_data,
+                    "created_at": now,
+                    "updated_at": now
+                })
                 print(f"✅ Created minimal template: {template_name}")
-                created_count += 1
             else:
                 print(f"⏭️ Template already exists: {template_name}")
         
+        if to_insert:
+            session.execute(insert(AgentTemplate), to_insert)
         session.commit()
-        print(f"📊 Created {created_count} minimal templates")
+        print(f"📊 Created {len(to_insert)} minimal templates")
         
     except Exception as e:
         session.rollback()
@@ -490,12 +602,14 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="SQLite Agent Template Management")
     parser.add_argument("action", choices=["sync", "list", "remove-all", "validate"], 
                        help="Action to perform")
+    parser.add_argument("--force", action="store_true",
+                       help="For sync: run the full sync even if nothing looks changed")
     
     args = parser.parse_args()
     
     if args.action == "sync":
         print("🚀 Synchronizing agents from agents_config.json to SQLite...")
-        sync_agents_from_config()
+        sync_agents_from_config(force=args.force)
     elif args.action == "list":
         list_templates()
     elif args.action == "validate":
@@ -1,5 +1,6 @@
 import logging
 import os
+from contextlib import contextmanager
 from dotenv import load_dotenv
 from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
@@ -15,10 +16,11 @@ DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///chat_database.db")
 # Determine database type and set appropriate engine configurations
 if DATABASE_URL.startswith('postgresql'):
     # PostgreSQL-specific configuration
+    # Pool size is configurable since template loaders may run concurrently in worker threads
     engine = create_engine(
         DATABASE_URL,
-        pool_size=10,
-        max_overflow=20,
+        pool_size=int(os.getenv("DB_POOL_SIZE", 10)),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 20)),
         pool_pre_ping=True,  # Check connection validity before use
         pool_recycle=300     # Recycle connections after 5 minutes
     )
@@ -64,5 +66,38 @@ def get_db():
 def is_postgres_db():
     return is_postgresql
 
+class QueryBudgetExceeded(Exception):
+    """Raised when a block executes more SQL statements than its declared budget."""
+
+@contextmanager
+def query_budget(max_queries, bind=None):
+    """
+    Count SQL statements executed on the engine inside the block and raise
+    QueryBudgetExceeded on exit if more than max_queries ran. Used to guard
+    loaders against N+1 query regressions, e.g.:
+
+        with query_budget(max_queries=1):
+            load_user_enabled_templates_for_planner_from_db(user_id, db_session)
+
+    Counts every statement on the engine, so run it where no other work shares the engine.
+    Yields the list of executed statements for inspection.
+    """
+    target = bind if bind is not None else engine
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(target, "before_cursor_execute", count_statement)
+    try:
+        yield statements
+    finally:
+        event.remove(target, "before_cursor_execute", count_statement)
+
+    if len(statements) > max_queries:
+        raise QueryBudgetExceeded(
+            f"Executed {len(statements)} queries, budget was {max_queries}:\n" + "\n".join(statements)
+        )
+
 if __name__ == "__main__":
     init_db() 
\ No newline at end of file
@@ -1,6 +1,7 @@
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, DateTime, Text, Float, Boolean, JSON, UniqueConstraint
+from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, DateTime, Text, Float, Boolean, JSON, UniqueConstraint, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.sql import func
 from datetime import datetime, UTC
 
 # Define the base class for declarative models
@@ -68,6 +69,11 @@ class ModelUsage(Base):
     # Add relationships
     user = relationship("User", back_populates="usage_records")
     chat = relationship("Chat", back_populates="usage_records")
+    
+    # Analytics filter by user over a time range
+    __table_args__ = (
+        Index('ix_model_usage_user_timestamp', 'user_id', 'timestamp'),
+    )
 
 # Define the Code Execution table
 class CodeExecution(Base):
@@ -99,7 +105,7 @@ class CodeExecution(Base):
     
     # Metadata
     created_at = Column(DateTime, default=lambda: datetime.now(UTC))
-    updated_at = Column(DateTime, default=lambda: datetime.now(UTC), onupdate=lambda: datetime.now(UTC))
+    updated_at = Column(DateTime, default=lambda: datetime.now(UTC), onupdate=lambda: datetime.now(UTC), server_default=func.now())
     
 class MessageFeedback(Base):
     """Tracks user feedback and model settings for each message."""
@@ -119,7 +125,7 @@ class MessageFeedback(Base):
 
     # Metadata
     created_at = Column(DateTime, default=lambda: datetime.now(UTC))
-    updated_at = Column(DateTime, default=lambda: datetime.now(UTC), onupdate=lambda: datetime.now(UTC))
+    updated_at = Column(DateTime, default=lambda: datetime.now(UTC), onupdate=lambda: datetime.now(UTC), server_default=func.now())
     
     # Relationship
     message = relationship("Message", back_populates="feedback")
@@ -168,7 +174,7 @@ class DeepAnalysisReport(Base):
     
     # Metadata
     created_at = Column(DateTime, default=lambda: datetime.now(UTC))
-    updated_at = Column(DateTime, default=lambda: datetime.now(UTC), onupdate=lambda: datetime.now(UTC))
+    updated_at = Column(DateTime, default=lambda: datetime.now(UTC), onupdate=lambda: datetime.now(UTC), server_default=func.now())
     
     # Relationships
     user = relationship("User", back_populates="deep_analysis_reports")
@@ -200,11 +206,16 @@ class AgentTemplate(Base):
     is_active = Column(Boolean, default=True)
     
     # Timestamps
-    created_at = Column(DateTime, default=lambda: datetime.now(UTC))
-    updated_at = Column(DateTime, default=lambda: datetime.now(UTC), onupdate=lambda: datetime.now(UTC))
+    created_at = Column(DateTime, default=lambda: datetime.now(UTC), server_default=func.now())
+    updated_at = Column(DateTime, default=lambda: datetime.now(UTC), onupdate=lambda: datetime.now(UTC), server_default=func.now())
     
     # Relationships
     user_preferences = relationship("UserTemplatePreference", back_populates="template", cascade="all, delete-orphan")
+    
+    # Template listings filter by category and active status
+    __table_args__ = (
+        Index('ix_agent_templates_category_active', 'category', 'is_active'),
+    )
 
 class UserTemplatePreference(Base):
     """Tracks user preferences and usage for agent templates."""
@@ -222,8 +233,8 @@ class UserTemplatePreference(Base):
     last_used_at = Column(DateTime, nullable=True)  # Last time user used this template
     
     # Timestamps
-    created_at = Column(DateTime, default=lambda: datetime.now(UTC))
-    updated_at = Column(DateTime, default=lambda: datetime.now(UTC), onupdate=lambda: datetime.now(UTC))
+    created_at = Column(DateTime, default=lambda: datetime.now(UTC), server_default=func.now())
+    updated_at = Column(DateTime, default=lambda: datetime.now(UTC), onupdate=lambda: datetime.now(UTC), server_default=func.now())
     
     # Relationships
     user = relationship("User", back_populates="template_preferences")
@@ -232,6 +243,15 @@ class UserTemplatePreference(Base):
     # Constraints - user can only have one preference record per template
     __table_args__ = (
         UniqueConstraint('user_id', 'template_id', name='unique_user_template_preference'),
+        Index('ix_utp_user_enabled', 'user_id', 'is_enabled'),
+        # Cascade deletes and usage updates look preferences up by template alone
+        Index('ix_utp_template_id', 'template_id'),
     )
+
+class AppMeta(Base):
+    """Small key/value store for application bookkeeping, e.g. the fingerprint of the last synced agent config."""
+    __tablename__ = 'app_meta'
     
-    
\ No newline at end of file
+    key = Column(String(100), primary_key=True)
+    value = Column(Text, nullable=True)
+    updated_at = Column(DateTime, default=lambda: datetime.now(UTC), onupdate=lambda: datetime.now(UTC), server_default=func.now())
@@ -5,7 +5,10 @@ from datetime import datetime, UTC
 
 from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import APIKeyHeader
+from sqlalchemy import insert
+from sqlalchemy.orm import defer
 
+from src.agents.agents import CORE_AGENT_NAMES
 from src.db.init_db import get_session
 from src.db.schemas.models import User as DBUser, AgentTemplate, UserTemplatePreference
 from src.schemas.user_schema import User
@@ -51,7 +54,7 @@ async def get_current_user(
                 # Check if api_key is actually a string before converting to int
                 if isinstance(api_key, str):
                     user_id = int(api_key)
-                    db_user = session.query(DBUser).filter(DBUser.user_id == user_id).first()
+                    db_user = session.get(DBUser, user_id)
                 else:
                     # Handle the case where api_key is not a string (like Depends object)
                     logger.log_message("API key is not a string", level=logging.ERROR)
@@ -139,39 +142,37 @@ def get_user_by_email(email: str) -> Optional[User]:
 def _enable_default_agents_for_user(user_id: int, session):
     """Enable default agents for a new user"""
     try:
-        # Get all default agents (the 4 built-in agents)
-        default_agent_names = [
-            "preprocessing_agent",
-            "statistical_analytics_agent", 
-            "sk_learn_agent",
-            "data_viz_agent"
-        ]
-        
-        # Find these agents in the database
-        default_agents = session.query(AgentTemplate).filter(
-            AgentTemplate.template_name.in_(default_agent_names),
+        # Find the default agents in the database
+        default_agents = session.query(AgentTemplate).options(defer(AgentTemplate.prompt_template)).filter(
+            AgentTemplate.template_name.in_(CORE_AGENT_NAMES),
             AgentTemplate.is_active == True
         ).all()
         
-        # Enable each default agent for the user
-        for agent in default_agents:
-            # Check if preference already exists
-            existing_pref = session.query(UserTemplatePreference).filter(
+        # Templates the user already has a preference for, fetched in one query
+        existing_template_ids = {
+            template_id for (template_id,) in session.query(UserTemplatePreference.template_id).filter(
                 UserTemplatePreference.user_id == user_id,
-                UserTemplatePreference.template_id == agent.template_id
-            ).first()
-            
-            if not existing_pref:
-                # Create new preference with enabled=True
-                new_pref = UserTemplatePreference(
-                    user_id=user_id,
-                    template_id=agent.template_id,
-                    is_enabled=True,  # Enable by default
-                    usage_count=0,
-                    created_at=datetime.now(UTC),
-                    updated_at=datetime.now(UTC)
-                )
-                session.add(new_pref)
+                UserTemplatePreference.template_id.in_([agent.template_id for agent in default_agents])
+            ).all()
+        }
+        
+        # Enable each default agent for the user, written as one executemany INSERT
+        # (the ORM would flush one INSERT ... RETURNING per preference)
+        now = datetime.now(UTC)
+        new_preferences = [
+            {
+                "user_id": user_id,
+                "template_id": agent.template_id,
+                "is_enabled": True,  # Enable by default
+                "usage_count": 0,
+                "created_at": now,
+                "updated_at": now
+            }
+            for agent in default_agents
+            if agent.template_id not in existing_template_ids
+        ]
+        if new_preferences:
+            session.execute(insert(UserTemplatePreference), new_preferences)
         
         session.commit()
         logger.log_message(f"Enabled {len(default_agents)} default agents for user {user_id}", level=logging.INFO)
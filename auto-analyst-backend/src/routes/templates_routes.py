@@ -6,6 +6,7 @@ from typing import List, Optional, Dict, Any
 from datetime import datetime, UTC
 from sqlalchemy import desc, func
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import defer
 
 from src.db.init_db import session_factory
 from src.db.schemas.models import AgentTemplate, User, UserTemplatePreference
@@ -20,6 +21,23 @@ logger = Logger("templates_routes", see_time=True, console_log=False)
 router = APIRouter(prefix="/templates", tags=["templates"])
 
 
+def get_user_preferences_by_template(session, user_id: int) -> Dict[int, UserTemplatePreference]:
+    """
+    Load all of a user's template preferences in one query.
+    
+    Args:
+        session: Database session
+        user_id: User whose preferences to load
+    
+    Returns:
+        Dict mapping template_id to the user's preference record
+    """
+    preferences = session.query(UserTemplatePreference).filter(
+        UserTemplatePreference.user_id == user_id
+    ).all()
+    return {preference.template_id: preference for preference in preferences}
+
+
 def get_global_usage_counts(session, template_ids: List[int] = None) -> Dict[int, int]:
     """
     Calculate global usage counts for templates by summing usage_count across all users.
@@ -116,12 +134,12 @@ async def get_user_template_preferences(user_id: int, variant_type: str = Query(
         
         try:
             # Validate user exists
-            user = session.query(User).filter(User.user_id == user_id).first()
+            user = session.get(User, user_id)
             if not user:
                 raise HTTPException(status_code=404, detail="User not found")
             
             # Get templates filtered by variant type (default to planner for modal)
-            query = session.query(AgentTemplate).filter(AgentTemplate.is_active == True)
+            query = session.query(AgentTemplate).options(defer(AgentTemplate.prompt_template)).filter(AgentTemplate.is_active == True)
             
             # Filter by variant type
             if variant_type and variant_type != "all":
@@ -153,12 +171,9 @@ async def get_user_template_preferences(user_id: int, variant_type: str = Query(
                 ]
             
             result = []
+            preferences = get_user_preferences_by_template(session, user_id)
             for template in templates:
-                # Get user preference for this template if it exists
-                preference = session.query(UserTemplatePreference).filter(
-                    UserTemplatePreference.user_id == user_id,
-                    UserTemplatePreference.template_id == template.template_id
-                ).first()
+                preference = preferences.get(template.template_id)
                 
                 # Determine if template should be enabled by default
                 is_default_agent = template.template_name in default_agent_names
@@ -202,12 +217,12 @@ async def get_user_enabled_templates(user_id: int, variant_type: str = Query(def
         
         try:
             # Validate user exists
-            user = session.query(User).filter(User.user_id == user_id).first()
+            user = session.get(User, user_id)
             if not user:
                 raise HTTPException(status_code=404, detail="User not found")
             
             # Get templates filtered by variant type (default to planner for modal)
-            query = session.query(AgentTemplate).filter(AgentTemplate.is_active == True)
+            query = session.query(AgentTemplate).options(defer(AgentTemplate.prompt_template)).filter(AgentTemplate.is_active == True)
             
             # Filter by variant type
             if variant_type and variant_type != "all":
@@ -239,12 +254,9 @@ async def get_user_enabled_templates(user_id: int, variant_type: str = Query(def
                 ]
             
             result = []
+            preferences = get_user_preferences_by_template(session, user_id)
             for template in all_templates:
-                # Check if user has a preference record for this template
-                preference = session.query(UserTemplatePreference).filter(
-                    UserTemplatePreference.user_id == user_id,
-                    UserTemplatePreference.template_id == template.template_id
-                ).first()
+                preference = preferences.get(template.template_id)
                 
                 # Determine if template should be enabled by default
                 is_default_agent = template.template_name in default_agent_names
@@ -289,7 +301,7 @@ async def get_user_enabled_templates_for_planner(user_id: int):
         
         try:
             # Validate user exists
-            user = session.query(User).filter(User.user_id == user_id).first()
+            user = session.get(User, user_id)
             if not user:
                 raise HTTPException(status_code=404, detail="User not found")
             
@@ -302,18 +314,15 @@ async def get_user_enabled_templates_for_planner(user_id: int):
             ]
             
             # Get all active planner variant templates
-            all_templates = session.query(AgentTemplate).filter(
+            all_templates = session.query(AgentTemplate).options(defer(AgentTemplate.prompt_template)).filter(
                 AgentTemplate.is_active == True,
                 AgentTemplate.variant_type.in_(['planner', 'both'])
             ).all()
             
             enabled_templates = []
+            preferences = get_user_preferences_by_template(session, user_id)
             for template in all_templates:
-                # Check if user has a preference record for this template
-                preference = session.query(UserTemplatePreference).filter(
-                    UserTemplatePreference.user_id == user_id,
-                    UserTemplatePreference.template_id == template.template_id
-                ).first()
+                preference = preferences.get(template.template_id)
                 
                 # Determine if template should be enabled by default
                 is_default_planner_agent = template.template_name in default_planner_agent_names
@@ -375,7 +384,7 @@ async def toggle_template_preference(user_id: int, template_id: int, request: To
         
         try:
             # Validate user exists
-            user = session.query(User).filter(User.user_id == user_id).first()
+            user = session.get(User, user_id)
             if not user:
                 raise HTTPException(status_code=404, detail="User not found")
             
@@ -391,18 +400,15 @@ async def toggle_template_preference(user_id: int, template_id: int, request: To
                 ]
                 
                 # Get all active planner templates (since this is used by the templates modal)
-                all_templates = session.query(AgentTemplate).filter(
+                all_templates = session.query(AgentTemplate).options(defer(AgentTemplate.prompt_template)).filter(
                     AgentTemplate.is_active == True,
                     AgentTemplate.variant_type.in_(['planner', 'both'])
                 ).all()
                 
                 enabled_count = 0
+                preferences = get_user_preferences_by_template(session, user_id)
                 for template in all_templates:
-                    # Check if user has a preference record for this template
-                    preference = session.query(UserTemplatePreference).filter(
-                        UserTemplatePreference.user_id == user_id,
-                        UserTemplatePreference.template_id == template.template_id
-                    ).first()
+                    preference = preferences.get(template.template_id)
                     
                     # Determine if template should be enabled by default
                     is_default_agent = template.template_name in default_agent_names
@@ -449,7 +455,7 @@ async def bulk_toggle_template_preferences(user_id: int, request: dict):
         
         try:
             # Validate user exists
-            user = session.query(User).filter(User.user_id == user_id).first()
+            user = session.get(User, user_id)
             if not user:
                 raise HTTPException(status_code=404, detail="User not found")
             
@@ -467,18 +473,15 @@ async def bulk_toggle_template_preferences(user_id: int, request: dict):
             
             # Calculate current enabled count properly (including defaults)
             # Focus on planner variants since this is used by the templates modal
-            all_templates = session.query(AgentTemplate).filter(
+            all_templates = session.query(AgentTemplate).options(defer(AgentTemplate.prompt_template)).filter(
                 AgentTemplate.is_active == True,
                 AgentTemplate.variant_type.in_(['planner', 'both'])
             ).all()
             
             current_enabled_count = 0
+            preferences = get_user_preferences_by_template(session, user_id)
             for template in all_templates:
-                # Check if user has a preference record for this template
-                preference = session.query(UserTemplatePreference).filter(
-                    UserTemplatePreference.user_id == user_id,
-                    UserTemplatePreference.template_id == template.template_id
-                ).first()
+                preference = preferences.get(template.template_id)
                 
                 # Determine if template should be enabled by default
                 is_default_planner_agent = template.template_name in default_planner_agent_names
@@ -554,9 +557,7 @@ async def get_template(template_id: int):
         session = session_factory()
         
         try:
-            template = session.query(AgentTemplate).filter(
-                AgentTemplate.template_id == template_id
-            ).first()
+            template = session.get(AgentTemplate, template_id)
             
             if not template:
                 raise HTTPException(status_code=404, detail=f"Template with ID {template_id} not found")
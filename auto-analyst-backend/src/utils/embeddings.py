@@ -0,0 +1,28 @@
+import threading
+
+_embedder = None
+_embedder_lock = threading.Lock()
+
+
+def get_embedder():
+    """
+    Process-wide embedding model, shared by the retrievers and the in-process caches.
+    Resolved on first use so importing this module doesn't load the model.
+    """
+    global _embedder
+    if _embedder is None:
+        with _embedder_lock:
+            if _embedder is None:
+                from llama_index.core import Settings
+                # Settings resolves its default model lazily; doing it under the lock keeps it to one instance
+                _embedder = Settings.embed_model
+    return _embedder
+
+
+def embed_text(text):
+    return get_embedder().get_text_embedding(text)
+
+
+def embed_texts(texts):
+    """Embed several texts in as few model calls as the embedder allows."""
+    return get_embedder().get_text_embedding_batch(list(texts))
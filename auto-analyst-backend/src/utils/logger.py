@@ -44,6 +44,10 @@ class Logger:
         else:
             self.logger.info(message)
 
+    def is_enabled_for(self, level: int) -> bool:
+        """Guard for messages that are expensive to build, e.g. ones that repr a whole plan."""
+        return self.is_dev and self.logger.isEnabledFor(level)
+
     def disable_logging(self):
         self.logger.disabled = True
 
@@ -0,0 +1,186 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+from src.utils.logger import Logger
+
+logger = Logger("plan_cache", see_time=True, console_log=False)
+
+# goal is normalized; dataset and agent descriptions are reduced to content hashes
+PlanCacheKey = namedtuple("PlanCacheKey", ["goal", "schema_hash", "agent_hash"])
+
+
+def content_hash(value):
+    """Short, stable hash of a value's string form."""
+    return hashlib.blake2b(str(value).encode("utf-8"), digest_size=16).hexdigest()
+
+
+# The dataset and agent description strings repeat across planner calls (they are built once per
+# session), and str objects cache their own hash, so repeated lookups here are cheap
+@lru_cache(maxsize=256)
+def _text_hash(text):
+    return content_hash(text)
+
+
+class SemanticPlanCache:
+    """
+    In-process cache of planner outputs.
+
+    Lookups match the exact (normalized goal, dataset, agents) key first. On a miss,
+    goals asked against the same dataset and agents are compared by embedding cosine
+    similarity, and a previous plan is reused when the score clears the threshold.
+    """
+
+    def __init__(self, embed_fn=None, embed_batch_fn=None, maxsize=512, similarity_threshold=0.92):
+        self.embed_fn = embed_fn
+        self.embed_batch_fn = embed_batch_fn
+        self.maxsize = maxsize
+        self.similarity_threshold = similarity_threshold
+        self._exact = OrderedDict()
+        # (scope, schema_hash, agent_hash) -> (matrix of unit goal embeddings, parallel lists of outputs and keys).
+        # Rows live only as long as their exact entry, so the buckets never hold more than
+        # two rows (unscoped and scoped) per cached key and empty buckets are dropped
+        self._buckets = {}
+        # Exact key -> bucket keys holding a row for it
+        self._rows = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(goal, dataset, agent_desc):
+        return PlanCacheKey(str(goal).strip().lower(), _text_hash(str(dataset)), _text_hash(str(agent_desc)))
+
+    def get(self, key):
+        """Return a copy of the output cached for exactly this key, or None."""
+        with self._lock:
+            output = self._exact.get(key)
+            if output is None:
+                return None
+            self._exact.move_to_end(key)
+            return dict(output)
+
+    def embed(self, key):
+        """Unit-length float32 embedding of the key's goal, or None if embeddings are unavailable."""
+        if self.embed_fn is None:
+            return None
+        try:
+            embedding = np.asarray(self.embed_fn(key.goal), dtype=np.float32)
+        except Exception as e:
+            logger.log_message(f"Error embedding goal for plan cache: {str(e)}", level=logging.WARNING)
+            return None
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else None
+
+    def embed_many(self, keys):
+        """Unit embeddings for several keys' goals in a single batch call, None where unavailable."""
+        if self.embed_batch_fn is None:
+            return [self.embed(key) for key in keys]
+        if not keys:
+            return []
+        try:
+            matrix = np.asarray(self.embed_batch_fn([key.goal for key in keys]), dtype=np.float32)
+        except Exception as e:
+            logger.log_message(f"Error embedding goals for plan cache: {str(e)}", level=logging.WARNING)
+            return [None] * len(keys)
+        norms = np.linalg.norm(matrix, axis=1)
+        return [row / norm if norm else None for row, norm in zip(matrix, norms)]
+
+    def get_similar(self, key, embedding, scope=None, threshold=None):
+        """
+        Return a copy of the closest cached output for the same dataset and agents, or None.
+
+        Args:
+            key: PlanCacheKey of the request
+            embedding: Unit goal embedding from embed()
+            scope: Only match outputs stored under the same scope (e.g. a complexity level)
+            threshold: Minimum cosine similarity, defaults to the cache's similarity_threshold
+        """
+        if embedding is None:
+            return None
+        threshold = self.similarity_threshold if threshold is None else threshold
+        with self._lock:
+            bucket = self._buckets.get((scope, key.schema_hash, key.agent_hash))
+            if bucket is None:
+                return None
+            matrix, outputs, _ = bucket
+            scores = matrix @ embedding
+            best = int(np.argmax(scores))
+            if scores[best] < threshold:
+                return None
+            return dict(outputs[best])
+
+    def get_similar_many(self, keys, embeddings, scope=None, threshold=None):
+        """
+        Batched get_similar(): goals sharing a bucket are scored against it in one matrix
+        product. Returns a list parallel to keys with a copied output or None.
+        """
+        threshold = self.similarity_threshold if threshold is None else threshold
+        results = [None] * len(keys)
+        groups = {}
+        for i, (key, embedding) in enumerate(zip(keys, embeddings)):
+            if embedding is not None:
+                groups.setdefault((scope, key.schema_hash, key.agent_hash), []).append(i)
+
+        with self._lock:
+            for bucket_key, indices in groups.items():
+                bucket = self._buckets.get(bucket_key)
+                if bucket is None:
+                    continue
+                matrix, outputs, _ = bucket
+                scores = np.stack([embeddings[i] for i in indices]) @ matrix.T
+                best = scores.argmax(axis=1)
+                for row, i in enumerate(indices):
+                    if scores[row, best[row]] >= threshold:
+                        results[i] = dict(outputs[best[row]])
+        return results
+
+    def put(self, key, output, embedding=None, scope=None):
+        """
+        Cache an output under its exact key. When an embedding is given, also add it to the
+        unscoped semantic bucket and, if a scope is given, to that scope's bucket.
+        """
+        output = dict(output)
+        with self._lock:
+            # A re-put replaces the key's semantic rows rather than adding duplicates
+            self._drop_rows(key)
+            self._exact[key] = output
+            self._exact.move_to_end(key)
+            if len(self._exact) > self.maxsize:
+                evicted, _ = self._exact.popitem(last=False)
+                self._drop_rows(evicted)
+
+            if embedding is None:
+                return
+            bucket_keys = {(bucket_scope, key.schema_hash, key.agent_hash) for bucket_scope in {None, scope}}
+            for bucket_key in bucket_keys:
+                self._add_to_bucket(bucket_key, key, embedding, output)
+            self._rows[key] = bucket_keys
+
+    def _add_to_bucket(self, bucket_key, key, embedding, output):
+        if bucket_key in self._buckets:
+            matrix, outputs, keys = self._buckets[bucket_key]
+            matrix = np.vstack([matrix, embedding])
+            outputs = outputs + [output]
+            keys = keys + [key]
+        else:
+            matrix, outputs, keys = embedding[np.newaxis, :], [output], [key]
+        self._buckets[bucket_key] = (matrix, outputs, keys)
+
+    def _drop_rows(self, key):
+        """Remove a key's rows from its buckets, deleting buckets left empty."""
+        for bucket_key in self._rows.pop(key, ()):
+            matrix, outputs, keys = self._buckets[bucket_key]
+            keep = [i for i, k in enumerate(keys) if k != key]
+            if not keep:
+                del self._buckets[bucket_key]
+                continue
+            self._buckets[bucket_key] = (matrix[keep], [outputs[i] for i in keep], [keys[i] for i in keep])
+
+    def clear(self):
+        with self._lock:
+            self._exact.clear()
+            self._buckets.clear()
+            self._rows.clear()
@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+# Point the app at a throwaway in-memory SQLite database before src.db.init_db builds its engine
+os.environ["DATABASE_URL"] = "sqlite://"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.db.init_db import engine, session_factory
+from src.db.schemas.models import Base, User, AgentTemplate, UserTemplatePreference
+
+DEFAULT_AGENTS = ("preprocessing_agent", "statistical_analytics_agent", "sk_learn_agent", "data_viz_agent")
+
+
+@pytest.fixture
+def db_session():
+    """Session on a fresh schema, seeded with one user, the default agents and their planner variants"""
+    Base.metadata.create_all(engine)
+    session = session_factory()
+    try:
+        session.add(User(user_id=1, username="budget_user", email="budget_user@example.com"))
+        for name in DEFAULT_AGENTS:
+            session.add(AgentTemplate(
+                template_name=name, description=f"{name} description", prompt_template=f"{name} prompt",
+                category="Data Manipulation", variant_type="individual"
+            ))
+            session.add(AgentTemplate(
+                template_name=f"planner_{name}", description=f"planner {name} description",
+                prompt_template=f"planner {name} prompt", category="Data Manipulation", variant_type="planner"
+            ))
+        session.add(AgentTemplate(
+            template_name="pytorch_specialist", description="PyTorch specialist", prompt_template="pytorch prompt",
+            category="Modelling", variant_type="both"
+        ))
+        session.flush()
+        custom = session.query(AgentTemplate).filter(AgentTemplate.template_name == "pytorch_specialist").one()
+        session.add(UserTemplatePreference(user_id=1, template_id=custom.template_id, is_enabled=True, usage_count=3))
+        session.commit()
+        yield session
+    finally:
+        session.close()
+        Base.metadata.drop_all(engine)
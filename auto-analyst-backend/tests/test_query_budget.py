@@ -0,0 +1,50 @@
+"""
+Query budgets for the template and user loaders. Each loader must stay within a fixed number
+of SQL statements no matter how many templates exist, so an N+1 regression fails CI.
+"""
+from src.db.init_db import query_budget
+from src.db.schemas.models import UserTemplatePreference
+from src.agents.agents import (
+    load_all_available_templates_from_db,
+    load_user_enabled_templates_for_planner_from_db,
+    load_user_enabled_templates_from_db,
+)
+from src.managers.user_manager import _enable_default_agents_for_user
+from src.routes.templates_routes import get_user_preferences_by_template
+
+USER_ID = 1
+
+
+def test_user_enabled_templates_loader(db_session):
+    # Active templates, then all of the user's preferences
+    with query_budget(max_queries=2):
+        signatures = load_user_enabled_templates_from_db(USER_ID, db_session)
+    assert {"preprocessing_agent", "pytorch_specialist"} <= set(signatures)
+
+
+def test_planner_templates_loader(db_session):
+    with query_budget(max_queries=1):
+        signatures = load_user_enabled_templates_for_planner_from_db(USER_ID, db_session)
+    assert "planner_preprocessing_agent" in signatures
+    assert "pytorch_specialist" in signatures
+
+
+def test_all_available_templates_loader(db_session):
+    with query_budget(max_queries=1):
+        signatures = load_all_available_templates_from_db(db_session)
+    assert "data_viz_agent" in signatures
+    assert "planner_data_viz_agent" not in signatures
+
+
+def test_user_preferences_loader(db_session):
+    with query_budget(max_queries=1):
+        preferences = get_user_preferences_by_template(db_session, USER_ID)
+    assert len(preferences) == 1
+
+
+def test_enable_default_agents(db_session):
+    # Default templates, existing preferences, then one batched INSERT
+    with query_budget(max_queries=3):
+        _enable_default_agents_for_user(USER_ID, db_session)
+    enabled = db_session.query(UserTemplatePreference).filter(UserTemplatePreference.user_id == USER_ID).count()
+    assert enabled == 5